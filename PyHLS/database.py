@@ -1,171 +1,223 @@
 import json
 import os
+import sqlite3
 import threading
-from datetime import datetime
 from typing import Dict, Optional
+from utils import utc_now_iso
 
 class VideoDatabase:
-    """Simple file-based database for video metadata"""
-    
-    def __init__(self, db_path: str = "video_database.json"):
+    """Simple SQLite-backed database for video metadata"""
+
+    def __init__(self, db_path: str = "video_database.db"):
         self.db_path = db_path
-        self.lock = threading.Lock()
+        self.lock = threading.RLock()
+        self._local = threading.local()
+        self._cache: Dict[str, Dict] = {}
+        self._by_internal: Dict[str, str] = {}
         self._init_database()
-    
+        self._load_cache()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Get the calling thread's connection, opening it on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
     def _init_database(self):
-        """Initialize database file if it doesn't exist"""
-        if not os.path.exists(self.db_path):
-            with open(self.db_path, 'w') as f:
-                json.dump({}, f)
-    
-    def _load_database(self) -> Dict:
-        """Load database from file"""
-        try:
-            with open(self.db_path, 'r') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {}
-    
-    def _save_database(self, data: Dict):
-        """Save database to file"""
-        # Create backup
-        backup_path = f"{self.db_path}.backup"
-        if os.path.exists(self.db_path):
-            os.rename(self.db_path, backup_path)
-        
+        """Create the videos table if it doesn't exist"""
+        conn = self._connection()
+        with self.lock, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS videos (
+                    public_id TEXT PRIMARY KEY,
+                    internal_id TEXT,
+                    data JSON NOT NULL,
+                    created_at TEXT,
+                    updated_at TEXT,
+                    expiry_minutes INTEGER,
+                    upload_time TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_videos_internal_id ON videos (internal_id)")
+        self._import_legacy_json()
+
+    def _import_legacy_json(self):
+        """Import entries from the old JSON database file, if one is present"""
+        legacy_path = f"{os.path.splitext(self.db_path)[0]}.json"
+        if not os.path.exists(legacy_path):
+            return
+
         try:
-            with open(self.db_path, 'w') as f:
-                json.dump(data, f, indent=2, default=str)
-            
-            # Remove backup if successful
-            if os.path.exists(backup_path):
-                os.remove(backup_path)
-                
-        except Exception as e:
-            # Restore backup if save failed
-            if os.path.exists(backup_path):
-                os.rename(backup_path, self.db_path)
-            raise e
-    
+            with open(legacy_path, 'r') as f:
+                legacy_data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return
+
+        conn = self._connection()
+        with self.lock, conn:
+            for public_id, video_data in legacy_data.items():
+                conn.execute(
+                    "INSERT OR IGNORE INTO videos VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    self._row(public_id, video_data)
+                )
+
+        # Move the old file aside so deleted entries aren't imported again
+        os.replace(legacy_path, f"{legacy_path}.imported")
+
+    def _load_cache(self):
+        """Load every entry into the in-process cache used by get_video"""
+        with self.lock:
+            cache = self.list_videos()
+            self._by_internal = {
+                video_data['internal_id']: public_id
+                for public_id, video_data in cache.items()
+                if video_data.get('internal_id')
+            }
+            self._cache = cache
+
+    def _cache_video(self, public_id: str, video_data: Dict):
+        """Put an entry in the cache and keep the internal ID index in step"""
+        # Swap the entry in with one assignment so lock-free readers never miss it
+        old_data = self._cache.get(public_id)
+        self._cache[public_id] = video_data
+
+        old_internal_id = old_data.get('internal_id') if old_data else None
+        if old_internal_id != video_data.get('internal_id') and self._by_internal.get(old_internal_id) == public_id:
+            del self._by_internal[old_internal_id]
+        if video_data.get('internal_id'):
+            self._by_internal[video_data['internal_id']] = public_id
+
+    def _uncache_video(self, public_id: str):
+        """Drop an entry and its internal ID from the cache"""
+        old_data = self._cache.pop(public_id, None)
+        if old_data and self._by_internal.get(old_data.get('internal_id')) == public_id:
+            del self._by_internal[old_data['internal_id']]
+
+    @staticmethod
+    def _row(public_id: str, video_data: Dict) -> tuple:
+        """Build a videos row from a metadata dict"""
+        return (
+            public_id,
+            video_data.get('internal_id'),
+            json.dumps(video_data, default=str),
+            video_data.get('created_at'),
+            video_data.get('updated_at'),
+            video_data.get('expiry_minutes', 60),
+            video_data.get('upload_time')
+        )
+
     def store_video(self, public_id: str, video_data: Dict):
         """Store video metadata"""
+        # Add timestamp
+        now = utc_now_iso()
+        video_data['created_at'] = now
+        video_data['updated_at'] = now
+
+        conn = self._connection()
         with self.lock:
-            db_data = self._load_database()
-            
-            # Add timestamp
-            video_data['created_at'] = datetime.utcnow().isoformat()
-            video_data['updated_at'] = datetime.utcnow().isoformat()
-            
-            db_data[public_id] = video_data
-            self._save_database(db_data)
-    
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    self._row(public_id, video_data)
+                )
+            # Only cache once the write has committed, as readers don't take the lock
+            self._cache_video(public_id, dict(video_data))
+
     def get_video(self, public_id: str) -> Optional[Dict]:
         """Retrieve video metadata"""
-        with self.lock:
-            db_data = self._load_database()
-            return db_data.get(public_id)
-    
+        # No lock: cached entries are replaced, never mutated, and dict reads are atomic
+        video_data = self._cache.get(public_id)
+        return dict(video_data) if video_data is not None else None
+
     def update_video(self, public_id: str, video_data: Dict):
         """Update video metadata"""
+        video_data['updated_at'] = utc_now_iso()
+        row = self._row(public_id, video_data)
+
+        conn = self._connection()
         with self.lock:
-            db_data = self._load_database()
-            
-            if public_id in db_data:
-                video_data['updated_at'] = datetime.utcnow().isoformat()
-                db_data[public_id] = video_data
-                self._save_database(db_data)
+            with conn:
+                cursor = conn.execute(
+                    """UPDATE videos SET internal_id = ?, data = ?, created_at = ?, updated_at = ?,
+                       expiry_minutes = ?, upload_time = ? WHERE public_id = ?""",
+                    row[1:] + (public_id,)
+                )
+            if cursor.rowcount > 0:
+                self._cache_video(public_id, dict(video_data))
                 return True
             return False
-    
+
     def delete_video(self, public_id: str) -> bool:
         """Delete video metadata"""
+        conn = self._connection()
         with self.lock:
-            db_data = self._load_database()
-            
-            if public_id in db_data:
-                del db_data[public_id]
-                self._save_database(db_data)
-                return True
-            return False
-    
+            with conn:
+                cursor = conn.execute("DELETE FROM videos WHERE public_id = ?", (public_id,))
+            self._uncache_video(public_id)
+            return cursor.rowcount > 0
+
     def list_videos(self, status: str = None) -> Dict:
         """List all videos, optionally filtered by status"""
-        with self.lock:
-            db_data = self._load_database()
-            
-            if status:
-                return {k: v for k, v in db_data.items() if v.get('status') == status}
-            
-            return db_data
-    
+        query = "SELECT public_id, data FROM videos"
+        params = ()
+
+        if status:
+            query += " WHERE json_extract(data, '$.status') = ?"
+            params = (status,)
+
+        rows = self._connection().execute(query, params).fetchall()
+        return {public_id: json.loads(data) for public_id, data in rows}
+
     def cleanup_expired_videos(self) -> int:
         """Remove expired video entries (for maintenance)"""
+        conn = self._connection()
         with self.lock:
-            db_data = self._load_database()
-            current_time = datetime.utcnow()
-            expired_count = 0
-            
-            videos_to_remove = []
-            
-            for public_id, video_data in db_data.items():
-                try:
-                    upload_time = datetime.fromisoformat(video_data['upload_time'])
-                    expiry_minutes = video_data.get('expiry_minutes', 60)
-                    
-                    if current_time > upload_time + timedelta(minutes=expiry_minutes):
-                        videos_to_remove.append(public_id)
-                        expired_count += 1
-                        
-                except (ValueError, KeyError):
-                    # Invalid date format or missing data
-                    continue
-            
-            # Remove expired videos
-            for public_id in videos_to_remove:
-                del db_data[public_id]
-            
-            if expired_count > 0:
-                self._save_database(db_data)
-            
-            return expired_count
-    
+            with conn:
+                cursor = conn.execute("""
+                    DELETE FROM videos
+                    WHERE datetime(upload_time, '+' || COALESCE(expiry_minutes, 60) || ' minutes') < datetime('now')
+                """)
+            if cursor.rowcount > 0:
+                self._load_cache()
+            return cursor.rowcount
+
     def get_video_by_internal_id(self, internal_id: str) -> Optional[Dict]:
         """Find video by internal ID (for maintenance tasks)"""
-        with self.lock:
-            db_data = self._load_database()
-            
-            for public_id, video_data in db_data.items():
-                if video_data.get('internal_id') == internal_id:
-                    return video_data
-            
-            return None
-    
+        public_id = self._by_internal.get(internal_id)
+        return self.get_video(public_id) if public_id else None
+
     def update_video_status(self, public_id: str, status: str):
         """Update only the status of a video"""
+        updated_at = utc_now_iso()
+
+        conn = self._connection()
         with self.lock:
-            db_data = self._load_database()
-            
-            if public_id in db_data:
-                db_data[public_id]['status'] = status
-                db_data[public_id]['updated_at'] = datetime.utcnow().isoformat()
-                self._save_database(db_data)
-                return True
-            return False
-    
+            with conn:
+                # Patch the two fields in place rather than rewriting the whole entry
+                cursor = conn.execute(
+                    """UPDATE videos SET data = json_set(data, '$.status', ?, '$.updated_at', ?),
+                       updated_at = ? WHERE public_id = ?""",
+                    (status, updated_at, updated_at, public_id)
+                )
+
+            if cursor.rowcount > 0 and public_id in self._cache:
+                self._cache[public_id] = {**self._cache[public_id], 'status': status, 'updated_at': updated_at}
+            return cursor.rowcount > 0
+
     def get_database_stats(self) -> Dict:
         """Get database statistics"""
-        with self.lock:
-            db_data = self._load_database()
-            
-            total_videos = len(db_data)
-            status_counts = {}
-            
-            for video_data in db_data.values():
-                status = video_data.get('status', 'unknown')
-                status_counts[status] = status_counts.get(status, 0) + 1
-            
-            return {
-                'total_videos': total_videos,
-                'status_distribution': status_counts,
-                'database_size_bytes': os.path.getsize(self.db_path) if os.path.exists(self.db_path) else 0
-            }
\ No newline at end of file
+        conn = self._connection()
+        total_videos = conn.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+        rows = conn.execute(
+            "SELECT COALESCE(json_extract(data, '$.status'), 'unknown'), COUNT(*) FROM videos GROUP BY 1"
+        ).fetchall()
+
+        return {
+            'total_videos': total_videos,
+            'status_distribution': dict(rows),
+            'database_size_bytes': os.path.getsize(self.db_path) if os.path.exists(self.db_path) else 0
+        }
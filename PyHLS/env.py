@@ -18,4 +18,13 @@ def generate_secret_key() -> str:
 
 # JWT Configuration
 SECRET_KEY = get_env_var("SECRET_KEY") or generate_secret_key()
-ALGORITHM = get_env_var("ALGORITHM", "HS256")
\ No newline at end of file
+ALGORITHM = get_env_var("ALGORITHM", "HS256")
+
+# Serving Configuration
+# When set (e.g. "/internal/hls"), segments are handed off to a fronting nginx
+# via X-Accel-Redirect instead of being streamed by Python
+ACCEL_REDIRECT_PREFIX = get_env_var("ACCEL_REDIRECT_PREFIX")
+
+# Encoding Configuration
+# Upper bound on ffmpeg processes running at once; extra uploads wait their turn
+MAX_CONCURRENT_ENCODES = int(get_env_var("MAX_CONCURRENT_ENCODES", str(os.cpu_count() or 1)))
\ No newline at end of file
@@ -1,18 +1,25 @@
+import asyncio
 import os
+import re
 import shutil
 import uuid
 import json
-from datetime import datetime, timedelta
+import aiofiles
+from functools import lru_cache
 from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Header, Request
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from fastapi.staticfiles import StaticFiles
-from utils import generate_hls, create_access_token, verify_access_token, hash_video_id
+from utils import generate_hls, create_access_token, verify_access_token, verify_admin_key, hash_video_id, utc_now_iso
 from database import VideoDatabase
+from env import ACCEL_REDIRECT_PREFIX
 from fastapi.openapi.utils import get_openapi
 
 app = FastAPI()
 MEDIA_ROOT = "media"
 HLS_ROOT = os.path.join(MEDIA_ROOT, "hls")
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+SEGMENT_NAME_RE = re.compile(r"segment[0-9]+\.ts")
+SEGMENT_LINE_RE = re.compile(rb"^(?:[^\n]*/)?([^/\n]+\.ts)[ \t\r]*$", re.MULTILINE)
 db = VideoDatabase()
 
 os.makedirs(HLS_ROOT, exist_ok=True)
@@ -37,20 +44,21 @@ async def upload_media(
     hls_dir = os.path.join(HLS_ROOT, internal_media_id)
     os.makedirs(hls_dir, exist_ok=True)
 
-    # Save uploaded media
-    with open(media_path, "wb") as f:
-        f.write(await media.read())
+    # Save uploaded media in chunks so large files never sit in memory
+    async with aiofiles.open(media_path, "wb") as f:
+        while chunk := await media.read(UPLOAD_CHUNK_SIZE):
+            await f.write(chunk)
 
     try:
         # Convert to HLS
-        generate_hls(media_path, hls_dir)
+        await generate_hls(media_path, hls_dir)
     except Exception as e:
-        shutil.rmtree(hls_dir)
+        await asyncio.to_thread(shutil.rmtree, hls_dir)
         raise HTTPException(status_code=500, detail=f"Encoding failed: {str(e)}!")
     finally:
         # Clean up original file to save space
         if os.path.exists(media_path):
-            os.remove(media_path)
+            await asyncio.to_thread(os.remove, media_path)
 
     # Store media metadata in database
     media_data = {
@@ -58,10 +66,10 @@ async def upload_media(
         "internal_id": internal_media_id,
         "access_key": access_key,
         "admin_key": admin_key,  # Store admin key for verification
-        "upload_time": datetime.utcnow().isoformat(),
+        "upload_time": utc_now_iso(),
         "expiry_minutes": expiry_minutes
     }
-    db.store_video(public_media_id, media_data)
+    await asyncio.to_thread(db.store_video, public_media_id, media_data)
 
     # Generate initial access token
     access_token = create_access_token(public_media_id, access_key, expiry_minutes)
@@ -70,7 +78,7 @@ async def upload_media(
         "media_id": public_media_id,
         "access_token": access_token,
         "admin_key": admin_key,  # IMPORTANT: Save this key! It's only shown once
-        "playlist_url": f"{request.base_url}stream/{public_media_id}/playlist.m3u8?token={access_token}",
+        "playlist_url": f"{request.base_url}stream/{public_media_id}/{access_token}/playlist.m3u8",
         "expires_in_minutes": expiry_minutes,
         "message": "Media uploaded and processed successfully. IMPORTANT: Save the admin_key - you'll need it for token refresh, deletion, and other admin operations!"
     }
@@ -87,7 +95,7 @@ def refresh_access_token(
         raise HTTPException(status_code=404, detail="Media not found!")
     
     # Verify that the admin key is valid
-    if media_data.get("admin_key") != admin_key:
+    if not verify_admin_key(media_data, admin_key):
         raise HTTPException(status_code=403, detail="Invalid admin key!")
     
     # Check if internal files still exist
@@ -103,69 +111,51 @@ def refresh_access_token(
     
     # Update expiry in database
     media_data["expiry_minutes"] = expiry_minutes
-    media_data["last_token_refresh"] = datetime.utcnow().isoformat()
+    media_data["last_token_refresh"] = utc_now_iso()
     db.update_video(media_id, media_data)
     
     return {
         "media_id": media_id,
         "access_token": access_token,
-        "playlist_url": f"{request.base_url}stream/{media_id}/playlist.m3u8?token={access_token}",
+        "playlist_url": f"{request.base_url}stream/{media_id}/{access_token}/playlist.m3u8",
         "expires_in_minutes": expiry_minutes,
         "message": "Access token refreshed successfully!"
     }
 
-@app.get("/stream/{media_id}/playlist.m3u8", summary="Retrieve a specific m3u8 file.")
-def get_playlist(media_id: str, access_token: str = Query(...,
-                                                        description="The `access_token` obtained in `upload`.",
-                                                        alias="token")):
+@app.get("/stream/{media_id}/{access_token}/playlist.m3u8", summary="Retrieve a specific m3u8 file.")
+def get_playlist(media_id: str, access_token: str):
     """Serve the HLS playlist after veryifying a valid token"""
-    media_data = db.get_video(media_id)
+    media_data = authorize_stream(media_id, access_token)
+    playlist_path = get_playlist_path(media_data)
     
-    if not media_data:
-        raise HTTPException(status_code=404, detail="Media not found!")
-    
-    if not verify_access_token(access_token, media_id, media_data["access_key"]):
-        raise HTTPException(status_code=403, detail="Invalid or expired access token!")
-    
-    internal_id = media_data["internal_id"]
-    playlist_path = os.path.join(HLS_ROOT, internal_id, "playlist.m3u8")
-    
-    if not os.path.exists(playlist_path):
-        raise HTTPException(status_code=404, detail="Playlist not found!")
+    # Segment URLs in the playlist are relative, so they resolve under this token's path
+    return FileResponse(playlist_path, media_type="application/vnd.apple.mpegurl")
+
+@app.get("/stream/{media_id}/{access_token}/{segment_name}", summary="Retrieve a specific segment in a m3u8 file.")
+def get_segment(media_id: str, access_token: str, segment_name: str):
+    """Serve video segments"""
+    media_data = authorize_stream(media_id, access_token)
+    return serve_segment(media_data, segment_name)
+
+@app.get("/stream/{media_id}/playlist.m3u8", summary="Retrieve a specific m3u8 file (token as a query parameter).")
+def get_legacy_playlist(media_id: str, access_token: str = Query(...,
+                                                        description="The `access_token` obtained in `upload`.",
+                                                        alias="token")):
+    """Serve the HLS playlist with tokens added to segment URLs, for links using `?token=`"""
+    media_data = authorize_stream(media_id, access_token)
+    playlist_path = get_playlist_path(media_data)
     
     # Rewrite playlist to include auth tokens in segment URLs
     updated_playlist = rewrite_playlist_with_auth_urls(playlist_path, media_id, access_token)
     
-    from fastapi.responses import Response
     return Response(content=updated_playlist, media_type="application/vnd.apple.mpegurl")
 
-@app.get("/stream/{media_id}/{segment_name}", summary="Retrieve a specific segment in a m3u8 file.")
-def get_segment(media_id: str, segment_name: str, access_token: str = Query(..., description="The `access_token` obtained in `upload`.",
+@app.get("/stream/{media_id}/{segment_name}", summary="Retrieve a specific segment in a m3u8 file (token as a query parameter).")
+def get_legacy_segment(media_id: str, segment_name: str, access_token: str = Query(..., description="The `access_token` obtained in `upload`.",
                                                                             alias="token")):
-    """Serve video segments"""
-    media_data = db.get_video(media_id)
-    
-    if not media_data:
-        raise HTTPException(status_code=404, detail="Media not found!")
-    
-    if not verify_access_token(access_token, media_id, media_data["access_key"]):
-        raise HTTPException(status_code=403, detail="Invalid or expired access token!")
-    
-    # Validate segment name to prevent path traversal
-    if not segment_name.endswith('.ts') or '/' in segment_name or '..' in segment_name:
-        raise HTTPException(status_code=400, detail="Invalid segment name!")
-    
-    internal_id = media_data["internal_id"]
-    segment_path = os.path.join(HLS_ROOT, internal_id, segment_name)
-    # Normalize and ensure segment_path is within the intended directory
-    abs_hls_dir = os.path.abspath(os.path.join(HLS_ROOT, internal_id))
-    norm_segment_path = os.path.abspath(os.path.normpath(segment_path))
-    if not norm_segment_path.startswith(abs_hls_dir + os.sep):
-        raise HTTPException(status_code=400, detail="Invalid segment path!")
-    if not os.path.exists(norm_segment_path):
-        raise HTTPException(status_code=404, detail="Segment not found")
-    
-    return FileResponse(norm_segment_path, media_type="video/MP2T")
+    """Serve video segments for links using `?token=`"""
+    media_data = authorize_stream(media_id, access_token)
+    return serve_segment(media_data, segment_name)
 
 @app.delete("/media/{media_id}", summary="Delete media from the db.")
 def delete_media(
@@ -179,14 +169,12 @@ def delete_media(
         raise HTTPException(status_code=404, detail="Media not found!")
     
     # Verify admin key as its a write operation
-    if media_data.get("admin_key") != admin_key:
+    if not verify_admin_key(media_data, admin_key):
         raise HTTPException(status_code=403, detail="Invalid admin key!")
     
     # Delete the entry from the db
     internal_id = media_data['internal_id']
-    contents = db._load_database()
-    del contents[media_id]
-    db._save_database(contents)
+    db.delete_video(media_id)
     
     hls_dir = os.path.join(HLS_ROOT, internal_id)
     if os.path.exists(hls_dir):
@@ -206,7 +194,7 @@ def get_media_info(
         raise HTTPException(status_code=404, detail="Media not found!")
     
     # Verify admin key for detailed info
-    if media_data.get("admin_key") != admin_key:
+    if not verify_admin_key(media_data, admin_key):
         raise HTTPException(status_code=403, detail="Invalid admin key!")
     
     return {
@@ -231,7 +219,7 @@ def extend_media_expiry(
         raise HTTPException(status_code=404, detail="Media not found!")
     
     # Verify admin key
-    if media_data.get("admin_key") != admin_key:
+    if not verify_admin_key(media_data, admin_key):
         raise HTTPException(status_code=403, detail="Invalid admin key!")
     
     # Update expiry
@@ -242,7 +230,7 @@ def extend_media_expiry(
     new_expiry = min(new_expiry, 10080)
     
     media_data["expiry_minutes"] = new_expiry
-    media_data["expiry_extended_at"] = datetime.utcnow().isoformat()
+    media_data["expiry_extended_at"] = utc_now_iso()
     db.update_video(media_id, media_data)
     
     return {
@@ -253,23 +241,63 @@ def extend_media_expiry(
         "message": "Media expiry successfully extended!"
     }
 
+def authorize_stream(media_id, access_token):
+    """Look up a media entry and check the access token for it"""
+    media_data = db.get_video(media_id)
+    
+    if not media_data:
+        raise HTTPException(status_code=404, detail="Media not found!")
+    
+    if not verify_access_token(access_token, media_id, media_data["access_key"]):
+        raise HTTPException(status_code=403, detail="Invalid or expired access token!")
+    
+    return media_data
+
+def get_playlist_path(media_data):
+    """Path to a media entry's playlist, raising 404 if it's missing"""
+    playlist_path = os.path.join(HLS_ROOT, media_data["internal_id"], "playlist.m3u8")
+    
+    if not os.path.exists(playlist_path):
+        raise HTTPException(status_code=404, detail="Playlist not found!")
+    
+    return playlist_path
+
+def serve_segment(media_data, segment_name):
+    """Build the response for one segment of an authorized media entry"""
+    # generate_hls only writes segment%d.ts, so anything else (including any
+    # path traversal attempt) is rejected before touching the filesystem
+    if not SEGMENT_NAME_RE.fullmatch(segment_name):
+        raise HTTPException(status_code=400, detail="Invalid segment name!")
+    
+    internal_id = media_data["internal_id"]
+    segment_path = os.path.join(HLS_ROOT, internal_id, segment_name)
+    if not os.path.exists(segment_path):
+        raise HTTPException(status_code=404, detail="Segment not found")
+    
+    # Let nginx sendfile the segment straight from disk if it's in front of us
+    if ACCEL_REDIRECT_PREFIX:
+        accel_path = f"{ACCEL_REDIRECT_PREFIX.rstrip('/')}/{internal_id}/{segment_name}"
+        return Response(media_type="video/MP2T", headers={"X-Accel-Redirect": accel_path})
+    
+    # FileResponse answers Range requests itself (206/416), as does nginx above
+    return FileResponse(segment_path, media_type="video/MP2T")
+
 def rewrite_playlist_with_auth_urls(playlist_path, media_id, auth_token):
     """Update playlist to include auth tokens in segment URLs"""
-    with open(playlist_path, "r") as f:
-        lines = f.readlines()
-    
-    new_lines = []
-    for line in lines:
-        line = line.strip()
-        if line.endswith(".ts"):
-            # Add auth token to segment URL
-            segment_name = line.split("/")[-1]  # Get just the filename
-            new_line = f"/stream/{media_id}/{segment_name}?token={auth_token}"
-            new_lines.append(new_line + "\n")
-        else:
-            new_lines.append(line + "\n")
-    
-    return "".join(new_lines)
+    # The mtime is part of the cache key so a re-encoded playlist isn't served stale
+    mtime = os.stat(playlist_path).st_mtime_ns
+    return _build_playlist(playlist_path, media_id, auth_token, mtime)
+
+@lru_cache(maxsize=1024)
+def _build_playlist(playlist_path, media_id, auth_token, mtime):
+    """Rewrite a playlist file, cached per media, token and file version"""
+    with open(playlist_path, "rb") as f:
+        playlist = f.read()
+    
+    # Add auth token to every segment URL, keeping just the filename
+    prefix = f"/stream/{media_id}/".encode()
+    suffix = f"?token={auth_token}".encode()
+    return SEGMENT_LINE_RE.sub(lambda match: prefix + match.group(1) + suffix, playlist)
 
 def custom_openapi():
     if app.openapi_schema:
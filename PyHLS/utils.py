@@ -1,12 +1,26 @@
+import asyncio
+import base64
+import binascii
 import os
-import subprocess
+import struct
 import jwt
 import hashlib
+import hmac
 import secrets
+import time
 from datetime import datetime, timedelta
-from env import SECRET_KEY, ALGORITHM
+from functools import lru_cache
+from env import SECRET_KEY, ALGORITHM, MAX_CONCURRENT_ENCODES
 
-def generate_hls(video_path, output_dir):
+TOKEN_NONCE_BYTES = 8
+
+# Shared by all uploads so encodes can't oversubscribe the CPU
+_encode_slots = asyncio.Semaphore(MAX_CONCURRENT_ENCODES)
+
+# (epoch second, ISO string) for the last call to utc_now_iso
+_now_iso_cache = (0, "")
+
+async def generate_hls(video_path, output_dir):
     """Convert video to HLS format"""
     os.makedirs(output_dir, exist_ok=True)
     playlist_path = os.path.join(output_dir, "playlist.m3u8")
@@ -22,73 +36,117 @@ def generate_hls(video_path, output_dir):
         playlist_path
     ]
     
-    try:
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
-        return playlist_path
-    except subprocess.CalledProcessError as e:
-        raise Exception(f"FFmpeg error: {e.stderr}")
+    # Run ffmpeg without blocking the event loop for the length of the encode
+    async with _encode_slots:
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            # Don't give the slot back while an orphaned ffmpeg is still encoding
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+            raise
+    
+    if process.returncode != 0:
+        raise Exception(f"FFmpeg error: {stderr.decode(errors='replace')}")
+    return playlist_path
 
 def create_access_token(media_id, access_key, expiry_minutes):
     """Create a secure access token for video streaming"""
-    now = datetime.utcnow()
-    
-    # Create a unique token ID for this specific token
-    token_id = secrets.token_hex(16)
-    
-    payload = {
-        "media_id": media_id,
-        "access_key_hash": hash_string(access_key),  # Don't store raw key in token
-        "iat": now,
-        "exp": now + timedelta(minutes=expiry_minutes),
-        "jti": token_id,  # Unique token identifier
-        "token_type": "access"
-    }
+    exp = int(time.time()) + expiry_minutes * 60
     
     # Use a combination of secret key and access key for signing
-    signing_key = generate_signing_key(SECRET_KEY, access_key)
-    return jwt.encode(payload, signing_key, algorithm=ALGORITHM)
+    signing_key = generate_signing_key(access_key)
+    return make_token(media_id, exp, signing_key)
 
 def verify_access_token(token, expected_video_id, access_key):
     """Verify access token and check permissions"""
-    try:
-        signing_key = generate_signing_key(SECRET_KEY, access_key)
-        payload = jwt.decode(token, signing_key, algorithms=[ALGORITHM])
-        
-        # Verify token type
-        if payload.get("token_type") != "access":
-            return False
-            
-        # Verify video ID matches
-        if payload.get("media_id") != expected_video_id:
-            return False
-            
-        # Verify access key hash
-        expected_hash = hash_string(access_key)
-        if payload.get("access_key_hash") != expected_hash:
-            return False
-            
-        return True
-        
-    except jwt.ExpiredSignatureError:
+    signing_key = generate_signing_key(access_key)
+    claims = check_token(token, signing_key)
+    
+    if claims is None:
         return False
-    except jwt.InvalidTokenError:
+    
+    media_id, exp = claims
+    
+    # Verify video ID matches
+    if media_id != expected_video_id:
         return False
-    except Exception:
+    
+    if exp <= time.time():
         return False
+        
+    return True
 
-def generate_signing_key(secret_key, access_key):
+def make_token(media_id, exp, signing_key):
+    """Build a compact token: base64url(media_id | exp | nonce).base64url(HMAC-SHA256)"""
+    message = media_id.encode() + struct.pack(">I", exp) + secrets.token_bytes(TOKEN_NONCE_BYTES)
+    signature = hmac.new(signing_key, message, hashlib.sha256).digest()
+    return f"{_b64encode(message)}.{_b64encode(signature)}"
+
+def check_token(token, signing_key):
+    """Return (media_id, exp) if the token's signature is valid, otherwise None"""
+    try:
+        encoded_message, encoded_signature = token.split(".")
+        message = _b64decode(encoded_message)
+        signature = _b64decode(encoded_signature)
+    except (ValueError, binascii.Error):
+        return None
+    
+    expected_signature = hmac.new(signing_key, message, hashlib.sha256).digest()
+    if not hmac.compare_digest(signature, expected_signature):
+        return None
+    
+    # exp and nonce are fixed width, so whatever comes before them is the media ID
+    tail_size = 4 + TOKEN_NONCE_BYTES
+    if len(message) <= tail_size:
+        return None
+    
+    media_id = message[:-tail_size].decode(errors="replace")
+    exp, = struct.unpack(">I", message[-tail_size:-TOKEN_NONCE_BYTES])
+    return media_id, exp
+
+def _b64encode(data):
+    """Unpadded URL-safe base64"""
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(data):
+    """Decode unpadded URL-safe base64"""
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def verify_admin_key(media_data, admin_key):
+    """Check an admin key against the stored one in constant time"""
+    expected = media_data.get("admin_key") or ""
+    return hmac.compare_digest(expected.encode(), admin_key.encode())
+
+@lru_cache(maxsize=4096)
+def generate_signing_key(access_key):
     """Generate a unique signing key for each video"""
-    combined = f"{secret_key}:{access_key}"
-    return hashlib.sha256(combined.encode()).hexdigest()
+    combined = f"{SECRET_KEY}:{access_key}"
+    return hashlib.sha256(combined.encode()).digest()  # Raw bytes, used directly as the HMAC key
 
+@lru_cache(maxsize=4096)
 def hash_string(value):
     """Create a secure hash of a string"""
     return hashlib.sha256(value.encode()).hexdigest()
 
 def hash_video_id(video_id):
     """Create a secure hash for internal storage mapping"""
-    salt = SECRET_KEY[:16]  # Use part of secret as salt
-    return hashlib.pbkdf2_hmac('sha256', video_id.encode(), salt.encode(), 100000).hex()
+    # Video IDs are random uuid4 values, so a keyed hash is enough without key stretching
+    return hmac.new(SECRET_KEY.encode(), video_id.encode(), hashlib.sha256).hexdigest()
+
+def utc_now_iso():
+    """Current UTC time as an ISO 8601 string, formatted at most once per second"""
+    global _now_iso_cache
+    now = int(time.time())
+    cached_second, cached_iso = _now_iso_cache
+    if cached_second != now:
+        cached_iso = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now))
+        _now_iso_cache = (now, cached_iso)
+    return cached_iso
 
 def generate_secure_filename():
     """Generate a cryptographically secure filename"""
@@ -99,9 +157,9 @@ def validate_token_format(token):
     if not token or not isinstance(token, str):
         return False
     
-    # JWT tokens have 3 parts separated by dots
+    # Access tokens have 2 parts separated by a dot
     parts = token.split('.')
-    if len(parts) != 3:
+    if len(parts) != 2:
         return False
         
     return True